@@ -1,7 +1,9 @@
 import datetime
+import math
 import pathlib
 from typing import ClassVar, Generator, Tuple
 
+import numpy as np
 import pandas as pd
 import torch
 
@@ -29,6 +31,7 @@ class Data:
     _time_tensor: torch.Tensor
     _normalized_time_tensor: torch.Tensor
     _normalized_timestep_delta: float
+    _time_window: torch.Tensor
 
     def __init__(
         self,
@@ -72,6 +75,15 @@ class Data:
         max_time = self._time_tensor.max()
         self._normalized_time_tensor = self._time_tensor / max_time
         self._normalized_timestep_delta = self._TIMESTEP_DELTA / max_time
+        if torch.isnan(self._normalized_time_tensor).any():
+            raise ValueError(f"can't normalize the time steps of {data_path}")
+
+        # All windows are sampled on the same equally spaced grid, so once shifted to
+        # start at 0 they share the same time steps
+        self._time_window = (
+            self._normalized_time_tensor[: self._window_length]
+            - self._normalized_time_tensor[0]
+        )
 
     @property
     def infect_means(self) -> torch.Tensor:
@@ -83,22 +95,42 @@ class Data:
 
     @property
     def num_windows(self) -> int:
-        return (
-            self._normalized_time_tensor.shape[0] - self._window_length
-        ) // self._window_length
+        # Same windows as `_data_windows` slices out
+        return len(
+            range(
+                0,
+                self._normalized_time_tensor.shape[0] - self._window_length,
+                self._window_length,
+            )
+        )
+
+    @property
+    def num_batches(self) -> int:
+        return math.ceil(self.num_windows / self._batch_size)
 
     def windows(
         self,
-    ) -> Generator[Tuple[torch.Tensor, torch.Tensor, torch.Tensor], None, None]:
-        yield from zip(
-            self._time_windows(),
+    ) -> Generator[
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor], None, None
+    ]:
+        """
+        Send batches of (time_window, start_time, weather_window, infect_window)
+
+        `time_window` holds the time steps of the windows counted from their start,
+        shape (window_length,), and is the same for every batch.
+        `start_time` holds the absolute start time of each window, shape (batch_size,)
+        """
+
+        for start_time, weather_window, infect_window in zip(
+            self._start_times(),
             self._weather_windows(),
             self._infect_windows(),
-        )
+        ):
+            yield self._time_window, start_time, weather_window, infect_window
 
     def weather_at_time(self, t: torch.Tensor) -> torch.Tensor:
         """
-        `t` is a scalar tensor due to how `odeint` works
+        `t` holds one time per window in the batch, shape (batch_size,)
 
         Obtain estimated weather conditions at that time `t`
         This is done by linearly interpolating between 2 adjacent timepoints
@@ -106,18 +138,17 @@ class Data:
         """
 
         inbetween = (
-            ((t % self._normalized_timestep_delta) / self._normalized_timestep_delta)
-            .unsqueeze(1)
-            .to(self._device)
+            (t % self._normalized_timestep_delta) / self._normalized_timestep_delta
+        ).unsqueeze(1)
+        left_index = (t // self._normalized_timestep_delta).long()
+
+        # `t` isn't checked for NaNs here: this runs on every solver step and the check
+        # would force a device sync each time. The time steps are checked once in `__init__`.
+        # Clamp each window's index separately so one out-of-range window in a batch
+        # doesn't drag the others to the edges of the data
+        left_index = left_index.clamp(
+            min=0, max=len(self._normalized_weather_tensor) - 2
         )
-        left_index = (t // self._normalized_timestep_delta).long().to(self._device)
-
-        if any(torch.isnan(t)):
-            raise ValueError()
-        if any(left_index < 0):
-            left_index = torch.zeros_like(left_index)
-        if any(left_index >= len(self._normalized_weather_tensor) - 2):
-            left_index = torch.zeros_like(left_index) - 2
 
         right_index = left_index + 1
 
@@ -144,24 +175,29 @@ class Data:
         """
 
         return (
-            torch.Tensor(
-                [
-                    data.RH.values,
-                    data.CM.values,
-                    data.CT.values,
-                ]
-            ).T.to(self._device),
-            torch.Tensor(
-                [
-                    data.num_infect.values,
-                ]
-            ).T.to(self._device),
+            self._to_device(
+                data[["RH", "CM", "CT"]].to_numpy(dtype="float32", copy=True)
+            ),
+            self._to_device(data[["num_infect"]].to_numpy(dtype="float32", copy=True)),
         )
 
+    def _to_device(self, array: np.ndarray) -> torch.Tensor:
+        """
+        Send the whole dataset to the device once, so windows are sliced from device memory.
+        The copy goes through pinned memory so it doesn't block on the GPU. `array` must be
+        writable, since `torch.from_numpy` shares its memory.
+        """
+
+        tensor = torch.from_numpy(array)
+        if self._device.type == "cuda":
+            tensor = tensor.pin_memory()
+        return tensor.to(self._device, non_blocking=True)
+
     def _generate_timesteps(self) -> torch.Tensor:
-        return torch.Tensor(
-            [i * self._TIMESTEP_DELTA for i, _ in enumerate(self._weather_tensor)]
-        ).to(self._device)
+        return (
+            torch.arange(len(self._weather_tensor), device=self._device)
+            * self._TIMESTEP_DELTA
+        )
 
     @staticmethod
     def _normalize_data(
@@ -187,10 +223,14 @@ class Data:
         for i in range(0, data.shape[0] - window_length, window_length):
             window_slice = slice(i, i + window_length)
             data_windows.append(data[window_slice])
-            if (i + 1) % batch_size == 0 or i == data.shape[0] - window_length:
+            if len(data_windows) == batch_size:
                 yield torch.stack(data_windows, dim=1)
                 data_windows = []
 
+        # The last batch may hold fewer than `batch_size` windows
+        if data_windows:
+            yield torch.stack(data_windows, dim=1)
+
     def _weather_windows(self) -> Generator[torch.Tensor, None, None]:
         yield from self._data_windows(
             self._normalized_weather_tensor,
@@ -205,9 +245,8 @@ class Data:
             batch_size=self._batch_size,
         )
 
-    def _time_windows(self) -> Generator[torch.Tensor, None, None]:
-        yield from self._data_windows(
-            self._normalized_time_tensor,
-            window_length=self._window_length,
-            batch_size=self._batch_size,
-        )
+    def _start_times(self) -> Generator[torch.Tensor, None, None]:
+        last_start = self._normalized_time_tensor.shape[0] - self._window_length
+        yield from self._normalized_time_tensor[
+            :last_start : self._window_length
+        ].split(self._batch_size)
@@ -16,6 +16,7 @@ class Hyperparameters:
     decoder_fc_dims: List[int]
     std: float
     window_length: int
+    batch_size: int
     num_epochs: int
     rtol: float
     atol: float
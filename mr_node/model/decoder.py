@@ -1,7 +1,7 @@
 from typing import List, Tuple
 
 import torch
-from mr_node.utils import pairwise
+from mr_node.utils import fc_forward, pairwise
 
 
 class Decoder(torch.nn.Module):
@@ -24,8 +24,6 @@ class Decoder(torch.nn.Module):
         )
 
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        for fc in self.fcs[:-1]:
-            x = fc(x)
-            x = torch.tanh(x)
-        x = self.fcs[-1](x)
-        return x
+        return fc_forward(
+            x, [fc.weight for fc in self.fcs], [fc.bias for fc in self.fcs]
+        )
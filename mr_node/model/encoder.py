@@ -33,9 +33,7 @@ class Encoder(torch.nn.Module):
         )
         self.dropout = torch.nn.Dropout(p=dropout_rate)
 
-    def forward(
-        self, x: torch.Tensor, h: torch.Tensor
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         `x` is arranged sequentially backwards in time
         It will now be encoded and the RNN will find a latent representation for the initial state of each window
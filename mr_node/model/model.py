@@ -48,7 +48,21 @@ class Model(torch.nn.Module):
         weather_window: torch.Tensor,
         infect_window: torch.Tensor,
         time_window: torch.Tensor,
+        start_time: torch.Tensor,
     ) -> torch.Tensor:
+        h = self.encode(weather_window=weather_window, infect_window=infect_window)
+        return self.integrate_and_decode(
+            h=h, time_window=time_window, start_time=start_time
+        )
+
+    def encode(
+        self,
+        weather_window: torch.Tensor,
+        infect_window: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Find the latent initial state `h` of each window, shape (batch_size, hidden_dims)
+        """
 
         data_window = torch.cat((weather_window, infect_window), dim=2)
         reversed_data_window = data_window.flip(0)
@@ -56,28 +70,41 @@ class Model(torch.nn.Module):
         # We feed the data to the encoder reversed so it comes up with `h` corresponding
         # to the latent encoding of the first element in the sequence chronologically,
         # with information from the future. We integrate that through time.
-        h_init = torch.randn(1, 1, self.hyperparams.hidden_dims).to(self.device)
-        _, h = self.encoder(reversed_data_window, h_init)
+        _, h = self.encoder(reversed_data_window)
 
-        # We squeeze the time and `h` to accommodate the batchless way that `odeint` works.
-        time_window = time_window.squeeze()
-        h = h.squeeze(dim=0)
+        # Drop the RNN layer dim so `h` is (batch_size, hidden_dims).
+        return h.squeeze(dim=0)
+
+    def integrate_and_decode(
+        self,
+        h: torch.Tensor,
+        time_window: torch.Tensor,
+        start_time: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Integrate the latent initial states `h` over `time_window` and decode them
+        to the number of infections at every time step
+
+        `time_window` starts at 0 and is shared by all windows, which only differ in
+        their `start_time`. `odefunc` needs the latter to look up the weather.
+        """
 
-        # Treat time steps as starting from 0
-        start_time = time_window[0]
         self.odefunc.start_time = start_time
-        time_window = time_window - start_time
 
-        # We integrate `h` through time for the relevant timesteps.
+        # We integrate `h` through time for the relevant timesteps, for all windows at once.
         # This gives us a sequence of latent encodings corresponding to the time steps.
-        hs = torchdiffeq.odeint(
-            self.odefunc,
-            h,
-            time_window,
-            rtol=self.hyperparams.rtol,
-            atol=self.hyperparams.atol,
-            method=self.hyperparams.solver,
-        ).to(self.device)
+        # The integration always runs in FP32, even under autocast: the normalized time
+        # step is ~1e-5, so in BF16 every solver increment would round away and `h`
+        # would never move.
+        with torch.autocast(device_type=h.device.type, enabled=False):
+            hs = torchdiffeq.odeint(
+                self.odefunc,
+                h.float(),
+                time_window,
+                rtol=self.hyperparams.rtol,
+                atol=self.hyperparams.atol,
+                method=self.hyperparams.solver,
+            )
 
         # Decode the hidden states integrated through time to the infections.
         return self.decoder(hs)
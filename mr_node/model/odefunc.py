@@ -2,13 +2,13 @@ from typing import List
 
 import torch
 from mr_node.data import Data
-from mr_node.utils import pairwise
+from mr_node.utils import fc_forward, pairwise
 
 
 class ODEFunc(torch.nn.Module):
     data: Data
     device: torch.device
-    start_time: int
+    start_time: torch.Tensor
 
     def __init__(
         self,
@@ -53,10 +53,8 @@ class ODEFunc(torch.nn.Module):
 
         t = t + self.start_time
         weather = self.data.weather_at_time(t)
-        x = torch.cat([weather, x], dim=-1).to(self.device)
+        x = torch.cat([weather, x], dim=-1)
 
-        for fc in self.fcs[:-1]:
-            x = fc(x)
-            x = torch.tanh(x)
-        x = self.fcs[-1](x)
-        return x
+        return fc_forward(
+            x, [fc.weight for fc in self.fcs], [fc.bias for fc in self.fcs]
+        )
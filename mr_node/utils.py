@@ -1,5 +1,8 @@
 import itertools
-from typing import Iterable, Tuple, TypeVar
+import math
+from typing import Iterable, List, Tuple, TypeVar
+
+import torch
 
 _T = TypeVar("_T")
 
@@ -11,6 +14,32 @@ def pairwise(iterable: Iterable[_T]) -> Iterable[Tuple[_T, _T]]:
     return zip(a, b)
 
 
+@torch.jit.script
+def fc_forward(
+    x: torch.Tensor, weights: List[torch.Tensor], biases: List[torch.Tensor]
+) -> torch.Tensor:
+    """
+    Run `x` through a stack of linear layers with tanh in between, none after the last one
+    This is scripted so the fuser can merge each linear + tanh instead of dispatching them
+    one by one from Python, which adds up inside `odeint`
+    """
+
+    for i in range(len(weights) - 1):
+        x = torch.tanh(torch.nn.functional.linear(x, weights[i], biases[i]))
+    return torch.nn.functional.linear(x, weights[-1], biases[-1])
+
+
+@torch.jit.script
+def gauss_nll(mu: torch.Tensor, x: torch.Tensor, std: float) -> torch.Tensor:
+    """
+    Negative log likelihood of `x` under a Normal(`mu`, `std`), element-wise
+    Same as `-Normal(mu, std).log_prob(x)` but in a single fused kernel, without
+    building a distribution and validating its arguments every step
+    """
+
+    return 0.5 * ((x - mu) / std) ** 2 + math.log(std * math.sqrt(2 * math.pi))
+
+
 def get_region_coords(region: str):
     if region.lower() == "cr":
         region_coords = ["-83.812_10.39"]
@@ -2,13 +2,24 @@ import math
 import argparse
 import pathlib
 
+import matplotlib
+
+# Figures are only ever saved to files, so skip setting up a GUI backend
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import numpy as np
 import torch
 
 from mr_node.data import Data
-from mr_node.utils import get_region_coords
+from mr_node.hyperparams import Hyperparameters
+from mr_node.model import Model
+from mr_node.utils import gauss_nll, get_region_coords
+
 
+# Every window has the same shape, so let cuDNN pick the fastest LSTM kernels once,
+# and allow TF32 for the matmuls on GPUs that support it
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 EXTRAPOLATION_WINDOW_LENGTH = 250
 GT_STEPS_FOR_EXTRAPOLATION = 100
@@ -28,15 +39,19 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
-def get_indexes_to_keep(original_length: int, num_to_keep: float):
+def get_indexes_to_keep(
+    original_length: int, num_to_keep: int, num_samples: int, device: torch.device
+) -> torch.Tensor:
     """
-    Randomly sample `num_to_keep` indexes without replacement
+    Randomly sample `num_to_keep` indexes without replacement, `num_samples` times
+    The indexes are sampled on `device` so indexing the windows with them stays there
+
+    Output shape is (num_samples, num_to_keep)
     """
-    indexes_to_keep = sorted(
-        np.random.choice(original_length, num_to_keep, replace=False)
-    )
+    random_order = torch.rand(num_samples, original_length, device=device)
+    random_order = random_order.argsort(dim=1)
 
-    return indexes_to_keep
+    return random_order[:, :num_to_keep].sort(dim=1).values
 
 
 def test() -> None:
@@ -46,7 +61,7 @@ def test() -> None:
     parser.add_argument("--region", default="cr", type=str)
     parser.add_argument(
         "--job_id",
-        default="cr_euler_lr3.0e-04_enc[8, 16, 8]_hidden4_ode[64, 64]_dec[8, 16, 8]_window128_epochs1_rtol0.0001_atol1e-06",
+        default="cr_euler_lr3.0e-04_enc[8, 16, 8]_hidden4_ode[64, 64]_dec[8, 16, 8]_window128_batch32_epochs1_rtol0.0001_atol1e-06",
         type=str,
     )
     parser.add_argument(
@@ -104,14 +119,14 @@ def test() -> None:
     )
 
     # Load the model
-    # Need to send different parts of the model to the correct device
-    best_model = torch.load(model_filepath, map_location=device)
-    best_model.device = device
-    best_model.encoder = best_model.encoder.to(device)
-    best_model.decoder = best_model.decoder.to(device)
-    best_model.odefunc = best_model.odefunc.to(device)
-    best_model.odefunc.data = test_data
-    best_model.odefunc.device = device
+    # Rebuild it on `device` around the test data, so its ODEFunc looks up test weather
+    checkpoint = torch.load(model_filepath, map_location=device)
+    best_model = Model(
+        data=test_data,
+        hyperparams=Hyperparameters(**checkpoint["hyperparams"]),
+        device=device,
+    )
+    best_model.load_state_dict(checkpoint["state_dict"])
 
     # Extrapolate
     # We'll give the first 100 time steps for it to produce z_t0
@@ -122,36 +137,46 @@ def test() -> None:
     if not plot_indiv:
         # Get ready to plot all windows on a single image
         side_len = math.ceil(math.sqrt(num_windows))
-        fig, axes = plt.subplots(side_len, side_len, figsize=(100, 35), sharey=True)
-        plt.tight_layout()
+        # Size the figure and its text to the number of windows and only create the axes
+        # that get used
+        fig = plt.figure(figsize=(2.5 * side_len, 1.5 * side_len))
+        axes = []
         plt.suptitle(
             "Neural ODE: Predicted vs GT number of infections (extrapolations are to the RHS of the vertical line)",
-            fontsize=40,
+            fontsize=2 * side_len,
         )
 
+    # Sample the indexes to keep for every window at once
+    all_indexes_to_keep = get_indexes_to_keep(
+        GT_STEPS_FOR_EXTRAPOLATION, num_to_keep, num_windows, device
+    )
+
     mse = torch.nn.MSELoss()
-    total_mse_loss = 0
-    total_mle_loss = 0
+    # Accumulate on the device and only sync once all windows are done
+    total_mse_loss = torch.zeros((), device=device)
+    total_mle_loss = torch.zeros((), device=device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # For every window, use the first 100 to produce the initial latent state
         # Then predict num_infect for those 100, as well as for 150 time steps in the future
-        for i, (time_window, gt_weather_window, gt_infect_window) in enumerate(
-            test_data.windows()
-        ):
+        for i, (
+            time_window,
+            start_time,
+            gt_weather_window,
+            gt_infect_window,
+        ) in enumerate(test_data.windows()):
             weather_window, infect_window = (
                 gt_weather_window[:GT_STEPS_FOR_EXTRAPOLATION],
                 gt_infect_window[:GT_STEPS_FOR_EXTRAPOLATION],
             )
 
-            indexes_to_keep = get_indexes_to_keep(
-                GT_STEPS_FOR_EXTRAPOLATION, num_to_keep
-            )
+            indexes_to_keep = all_indexes_to_keep[i]
 
             infect_hat = best_model(
                 time_window=time_window,
-                weather_window=weather_window[indexes_to_keep],
-                infect_window=infect_window[indexes_to_keep],
+                start_time=start_time,
+                weather_window=weather_window.index_select(0, indexes_to_keep),
+                infect_window=infect_window.index_select(0, indexes_to_keep),
             )
 
             # Denormalize using means and stds from TRAINING data
@@ -166,24 +191,24 @@ def test() -> None:
             mse_loss = mse(extrapol_pred_infect, extrapol_gt_infect)
 
             # Calculate MLE loss only for extrapolation
-            infect_dist = torch.distributions.normal.Normal(
-                pred_infect[GT_STEPS_FOR_EXTRAPOLATION:].squeeze(), 0.1
-            )
-            mle_loss = -infect_dist.log_prob(
-                gt_infect[GT_STEPS_FOR_EXTRAPOLATION:].squeeze()
+            mle_loss = gauss_nll(
+                pred_infect[GT_STEPS_FOR_EXTRAPOLATION:].squeeze(),
+                gt_infect[GT_STEPS_FOR_EXTRAPOLATION:].squeeze(),
+                0.1,
             ).mean()
 
             # Accumulate losses
-            total_mle_loss += mle_loss.item()
-            total_mse_loss += mse_loss.item()
+            total_mle_loss += mle_loss
+            total_mse_loss += mse_loss
 
             # Plot predictions
             dates = test_data.dates[
                 i * EXTRAPOLATION_WINDOW_LENGTH : (i + 1) * EXTRAPOLATION_WINDOW_LENGTH
             ].to_list()
             demarcation = dates[GT_STEPS_FOR_EXTRAPOLATION]
-            pred_infect = pred_infect.squeeze(-1).squeeze(-1).numpy()
-            gt_infect = gt_infect.squeeze(-1).squeeze(-1).numpy()
+            # Matplotlib needs host arrays, so bring the window back from the device
+            pred_infect = pred_infect.squeeze(-1).squeeze(-1).cpu().numpy()
+            gt_infect = gt_infect.squeeze(-1).squeeze(-1).cpu().numpy()
 
             # Plot each window individually
             if plot_indiv:
@@ -202,22 +227,25 @@ def test() -> None:
                     plots_dir / f"{job_id}_{first_date}_{last_date}.png"
                 )
                 plt.savefig(individual_extrapolation_plot_filepath)
+                plt.close()
             else:
                 # Prepare data to plot all windows on a single image
-                row_idx = i // side_len
-                col_idx = i % side_len
-                axes[row_idx, col_idx].plot(dates, pred_infect, label="Prediction")
-                axes[row_idx, col_idx].plot(dates, gt_infect, label="Ground truth")
-                axes[row_idx, col_idx].axvline(
+                ax = fig.add_subplot(
+                    side_len, side_len, i + 1, sharey=axes[0] if axes else None
+                )
+                axes.append(ax)
+                ax.plot(dates, pred_infect, label="Prediction")
+                ax.plot(dates, gt_infect, label="Ground truth")
+                ax.axvline(
                     x=demarcation, color="gray", linewidth=2, linestyle="solid"
                 )
-                axes[row_idx, col_idx].set_xlabel("Date")
-                axes[row_idx, col_idx].set_ylabel("num_infect")
+                ax.set_xlabel("Date")
+                ax.set_ylabel("num_infect")
 
     # Note down the test set loss
     loss_txt_filepath = plots_dir / f"{job_id}_test_loss.txt"
-    avg_mle_loss = total_mle_loss / test_data.num_windows
-    avg_mse_loss = total_mse_loss / test_data.num_windows
+    avg_mle_loss = total_mle_loss.item() / test_data.num_windows
+    avg_mse_loss = total_mse_loss.item() / test_data.num_windows
     msg = f"Avg test MLE loss: {avg_mle_loss}\nAvg test MSE loss: {avg_mse_loss}\n"
     with open(loss_txt_filepath, "w") as f:
         f.writelines(msg)
@@ -225,15 +253,8 @@ def test() -> None:
 
     # Plot all windows on a single image
     if not plot_indiv:
-        for j in range(num_windows + 1, side_len ** 2):
-            row_idx = j // side_len
-            col_idx = j % side_len
-            fig.delaxes(axes[row_idx][col_idx])
-
-        row_idx_final = (num_windows - 1) // side_len
-        col_idx_final = (num_windows - 1) % side_len
-        lines, labels = axes[row_idx_final, col_idx_final].get_legend_handles_labels()
-        fig.legend(lines, labels, fontsize=40, loc="upper left")
+        lines, labels = axes[-1].get_legend_handles_labels()
+        fig.legend(lines, labels, fontsize=1.5 * side_len, loc="upper left")
         extrapolation_plot_filepath = plots_dir / f"{job_id}.png"
         plt.savefig(extrapolation_plot_filepath)
 
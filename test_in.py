@@ -2,27 +2,44 @@ import math
 import argparse
 import pathlib
 
+import matplotlib
+
+# Figures are only ever saved to files, so skip setting up a GUI backend
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import numpy as np
 import torch
 
 from mr_node.data import Data
+from mr_node.hyperparams import Hyperparameters
+from mr_node.model import Model
+from mr_node.utils import gauss_nll
+
 
+# Every window has the same shape, so let cuDNN pick the fastest LSTM kernels once,
+# and allow TF32 for the matmuls on GPUs that support it
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 EXTRAPOLATION_WINDOW_LENGTH = 250
 GT_STEPS_FOR_EXTRAPOLATION = 100
 
 
-def get_indexes_to_keep(original_length: int, drop_rate: float):
+def get_indexes_to_keep(
+    original_length: int, drop_rate: float, num_samples: int, device: torch.device
+) -> torch.Tensor:
     """
-    Randomly sample `(1 - drop_rate) * original_length` indexes without replacement
+    Randomly sample `(1 - drop_rate) * original_length` indexes without replacement,
+    `num_samples` times
+    The indexes are sampled on `device` so indexing the windows with them stays there
+
+    Output shape is (num_samples, num_to_keep)
     """
-    num_to_keep = np.floor(original_length * (1 - drop_rate)).astype(int)
-    indexes_to_keep = sorted(np.random.choice(
-        original_length, num_to_keep, replace=False
-    ))
+    num_to_keep = math.floor(original_length * (1 - drop_rate))
+    random_order = torch.rand(num_samples, original_length, device=device)
+    random_order = random_order.argsort(dim=1)
 
-    return indexes_to_keep
+    return random_order[:, :num_to_keep].sort(dim=1).values
 
 
 def test() -> None:
@@ -44,6 +61,11 @@ def test() -> None:
         default=0,
         type=float,
     )
+    parser.add_argument(
+        "--num_trials",
+        default=1,
+        type=int,
+    )
     args = parser.parse_args()
 
     # Get all folders and files
@@ -86,14 +108,16 @@ def test() -> None:
     )
 
     # Load the model
-    # Need to send different parts of the model to the correct device
-    best_model = torch.load(model_filepath, map_location=device)
-    best_model.device = device
-    best_model.encoder = best_model.encoder.to(device)
-    best_model.decoder = best_model.decoder.to(device)
-    best_model.odefunc = best_model.odefunc.to(device)
-    best_model.odefunc.data = test_data
-    best_model.odefunc.device = device
+    # Rebuild it on `device` around the test data, so its ODEFunc looks up test weather
+    checkpoint = torch.load(model_filepath, map_location=device)
+    best_model = Model(
+        data=test_data,
+        hyperparams=Hyperparameters(**checkpoint["hyperparams"]),
+        device=device,
+    )
+    best_model.load_state_dict(checkpoint["state_dict"])
+    # Turn off the encoder's dropout, so every trial sees the same model
+    best_model.eval()
 
     # Extrapolate
     # We'll give the first 100 time steps for it to produce z_t0
@@ -104,64 +128,96 @@ def test() -> None:
     if not args.plot_indiv:
         # Get ready to plot all windows on a single image
         side_len = math.ceil(math.sqrt(num_windows))
-        fig, axes = plt.subplots(side_len, side_len, figsize=(100, 35), sharey=True)
-        plt.tight_layout()
+        # Size the figure and its text to the number of windows and only create the axes
+        # that get used
+        fig = plt.figure(figsize=(2.5 * side_len, 1.5 * side_len))
+        axes = []
         plt.suptitle(
             "Neural ODE: Predicted vs GT number of infections (extrapolations are to the RHS of the vertical line)",
-            fontsize=40,
+            fontsize=2 * side_len,
         )
 
     mse = torch.nn.MSELoss()
-    total_mse_loss = 0
-    total_mle_loss = 0
+    # Accumulate on the device and only sync once all windows are done
+    total_mse_loss = torch.zeros((), device=device)
+    total_mle_loss = torch.zeros((), device=device)
+
+    # Sample the indexes to keep for every window and trial at once. The cache keys are
+    # read back to the host in one go as well.
+    all_indexes_to_keep = get_indexes_to_keep(
+        GT_STEPS_FOR_EXTRAPOLATION,
+        args.drop_rate,
+        num_windows * args.num_trials,
+        device,
+    ).view(num_windows, args.num_trials, -1)
+    all_keys = all_indexes_to_keep.tolist()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # For every window, use the first 100 to produce the initial latent state
         # Then predict num_infect for those 100, as well as for 150 time steps in the future
-        for i, (time_window, gt_weather_window, gt_infect_window) in enumerate(
-            test_data.windows()
-        ):
+        for i, (
+            time_window,
+            start_time,
+            gt_weather_window,
+            gt_infect_window,
+        ) in enumerate(test_data.windows()):
             weather_window, infect_window = (
                 gt_weather_window,
                 gt_infect_window,
             )
 
-            indexes_to_keep = get_indexes_to_keep(GT_STEPS_FOR_EXTRAPOLATION, args.drop_rate)
-
-            infect_hat = best_model(
-                time_window=time_window,
-                weather_window=weather_window[indexes_to_keep],
-                infect_window=infect_window[indexes_to_keep],
-            )
-
-            # Denormalize using means and stds from TRAINING data
-            pred_infect = infect_hat * train_data.infect_stds + train_data.infect_means
             gt_infect = (
                 gt_infect_window * test_data.infect_stds + test_data.infect_means
             )
-            
-            # Calculate MSE loss only for intrapolation
-            extrapol_pred_infect = pred_infect
-            extrapol_gt_infect = gt_infect
-            mse_loss = mse(extrapol_pred_infect, extrapol_gt_infect)
-
-            # Calculate MLE loss only for iinitrapolation
-            infect_dist = torch.distributions.normal.Normal(
-                pred_infect.squeeze(), 0.1
-            )
-            mle_loss = -infect_dist.log_prob(gt_infect.squeeze()).mean()
 
-            # Accumulate losses
-            total_mle_loss += mle_loss.item()
-            total_mse_loss += mse_loss.item()
+            # Average the losses and predictions over several random drops of the
+            # window. Trials that keep the same indexes reuse the window's prediction
+            # instead of running the model again.
+            trials_pred_infect = []
+            predicted = {}
+            for trial in range(args.num_trials):
+                indexes_to_keep = all_indexes_to_keep[i, trial]
+
+                key = tuple(all_keys[i][trial])
+                if key not in predicted:
+                    infect_hat = best_model(
+                        weather_window=weather_window.index_select(0, indexes_to_keep),
+                        infect_window=infect_window.index_select(0, indexes_to_keep),
+                        time_window=time_window,
+                        start_time=start_time,
+                    )
+
+                    # Denormalize using means and stds from TRAINING data
+                    predicted[key] = (
+                        infect_hat * train_data.infect_stds + train_data.infect_means
+                    )
+                pred_infect = predicted[key]
+                trials_pred_infect.append(pred_infect)
+
+                # Calculate MSE loss only for intrapolation
+                extrapol_pred_infect = pred_infect
+                extrapol_gt_infect = gt_infect
+                mse_loss = mse(extrapol_pred_infect, extrapol_gt_infect)
+
+                # Calculate MLE loss only for iinitrapolation
+                mle_loss = gauss_nll(
+                    pred_infect.squeeze(), gt_infect.squeeze(), 0.1
+                ).mean()
+
+                # Accumulate losses
+                total_mle_loss += mle_loss / args.num_trials
+                total_mse_loss += mse_loss / args.num_trials
+
+            pred_infect = torch.stack(trials_pred_infect).mean(dim=0)
 
             # Plot predictions
             dates = test_data.dates[
                 i * GT_STEPS_FOR_EXTRAPOLATION : (i+1) * GT_STEPS_FOR_EXTRAPOLATION
             ].to_list()
             # demarcation = dates
-            pred_infect = pred_infect.squeeze(-1).squeeze(-1).numpy()
-            gt_infect = gt_infect.squeeze(-1).squeeze(-1).numpy()
+            # Matplotlib needs host arrays, so bring the window back from the device
+            pred_infect = pred_infect.squeeze(-1).squeeze(-1).cpu().numpy()
+            gt_infect = gt_infect.squeeze(-1).squeeze(-1).cpu().numpy()
 
             # Plot each window individually
             if args.plot_indiv:
@@ -180,22 +236,25 @@ def test() -> None:
                     plots_dir / f"{args.job_id}_{first_date}_{last_date}.png"
                 )
                 plt.savefig(individual_extrapolation_plot_filepath)
+                plt.close()
             else:
                 # Prepare data to plot all windows on a single image
-                row_idx = i // side_len
-                col_idx = i % side_len
-                axes[row_idx, col_idx].plot(dates, gt_infect, label="Ground truth")
-                axes[row_idx, col_idx].plot(dates, pred_infect, label="Prediction")
-                axes[row_idx, col_idx].axvline(
+                ax = fig.add_subplot(
+                    side_len, side_len, i + 1, sharey=axes[0] if axes else None
+                )
+                axes.append(ax)
+                ax.plot(dates, gt_infect, label="Ground truth")
+                ax.plot(dates, pred_infect, label="Prediction")
+                ax.axvline(
                     # x=demarcation, color="gray", linewidth=2, linestyle="solid"
                 )
-                axes[row_idx, col_idx].set_xlabel("Date")
-                axes[row_idx, col_idx].set_ylabel("num_infect")
+                ax.set_xlabel("Date")
+                ax.set_ylabel("num_infect")
             
     # Note down the test set loss
     loss_txt_filepath = plots_dir / f"{args.job_id}_test_loss.txt"
-    avg_mle_loss = total_mle_loss / test_data.num_windows
-    avg_mse_loss = total_mse_loss / test_data.num_windows
+    avg_mle_loss = total_mle_loss.item() / test_data.num_windows
+    avg_mse_loss = total_mse_loss.item() / test_data.num_windows
     msg = f"Avg test MLE loss: {avg_mle_loss}\nAvg test MSE loss: {avg_mse_loss}\n"
     with open(loss_txt_filepath, "w") as f:
         f.writelines(msg)
@@ -203,15 +262,8 @@ def test() -> None:
 
     # Plot all windows on a single image
     if not args.plot_indiv:
-        for j in range(num_windows + 1, side_len ** 2):
-            row_idx = j // side_len
-            col_idx = j % side_len
-            fig.delaxes(axes[row_idx][col_idx])
-
-        row_idx_final = (num_windows - 1) // side_len
-        col_idx_final = (num_windows - 1) % side_len
-        lines, labels = axes[row_idx_final, col_idx_final].get_legend_handles_labels()
-        fig.legend(lines, labels, fontsize=40, loc="upper left")
+        lines, labels = axes[-1].get_legend_handles_labels()
+        fig.legend(lines, labels, fontsize=1.5 * side_len, loc="upper left")
         extrapolation_plot_filepath = plots_dir / f"{args.job_id}.png"
         plt.savefig(extrapolation_plot_filepath)
 